@@ -2,16 +2,26 @@
 Module interfacing with the Swisscom API to get heatmap data
 """
 import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 
 BASE_URL = "https://api.swisscom.com/layer/heatmaps/demo"
 TOKEN_URL = "https://consent.swisscom.com/o/oauth2/token"
 MAX_NB_TILES_REQUEST = 100
+POOL_SIZE = 20  # number of connections kept alive to the API
+MAX_WORKERS = 8  # max number of concurrent requests to the API
+TOKEN_FILE = ".swisscom_token.json"  # local copy of the last access token
+TOKEN_MIN_VALIDITY = 60  # seconds left before a token is considered expired
 headers = {"scs-version": "2"}  # API version
 
+_CACHED_HANDLE = None
+
 # load environmental variables
 load_dotenv()
 
@@ -24,6 +34,31 @@ def __get_credentials():
     return client_id, client_secret
 
 
+def __is_token_valid(token):
+    return token.get('expires_at', 0) - time.time() > TOKEN_MIN_VALIDITY
+
+
+def __load_token(client_id):
+    try:
+        with open(TOKEN_FILE) as f:
+            saved = json.load(f)
+        # ignore tokens of other clients (e.g. credentials changed in .env)
+        if saved['client_id'] != client_id:
+            return None
+        token = saved['token']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return token if __is_token_valid(token) else None
+
+
+def __save_token(client_id, token):
+    # the token grants access to the API, keep it readable by the owner only
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(TOKEN_FILE, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'client_id': client_id, 'token': token}, f)
+
+
 def check_token_validity(api_handle):
     """Check the validity of the token
 
@@ -38,16 +73,33 @@ def check_token_validity(api_handle):
 def get_api_handle():
     """Get the oauth request object with a valid authentication
 
+    The returned handle keeps its connections to the API alive and is meant to
+    be long-lived: create it once and reuse it for all the requests.
+    The handle is cached and its token saved in TOKEN_FILE, a new token is only
+    fetched when the cached one is about to expire.
+
     :return: oauth request object
     """
+    global _CACHED_HANDLE
+    if _CACHED_HANDLE is not None and __is_token_valid(_CACHED_HANDLE.token):
+        return _CACHED_HANDLE
+
     # get access credentials
     client_id, client_secret = __get_credentials()
 
-    # Fetch an access token
     client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client)
-    oauth.fetch_token(token_url=TOKEN_URL, client_id=client_id,
-                      client_secret=client_secret)
+    token = __load_token(client_id)
+    oauth = OAuth2Session(client=client, token=token)
+    if token is None:
+        # Fetch an access token
+        token = oauth.fetch_token(token_url=TOKEN_URL, client_id=client_id,
+                                  client_secret=client_secret)
+        __save_token(client_id, token)
+    # larger connection pool and persistent API version header
+    oauth.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE,
+                                        pool_maxsize=POOL_SIZE))
+    oauth.headers.update(headers)
+    _CACHED_HANDLE = oauth
     return oauth
 
 
@@ -58,7 +110,7 @@ def get_tile_ids_from_district(api_handle, district_nbr):
     :param district_nbr: the district to query
     :return: json response from the API
     """
-    return api_handle.get(BASE_URL + "/grids/districts/{0}".format(district_nbr), headers=headers)
+    return api_handle.get(BASE_URL + "/grids/districts/{0}".format(district_nbr))
 
 
 def get_dwell_density(api_handle, query_date, tiles):
@@ -69,5 +121,36 @@ def get_dwell_density(api_handle, query_date, tiles):
     :param tiles: the tile ids (in list format) to query
     :return: json response from the API
     """
-    url = BASE_URL + "/heatmaps/dwell-density/hourly/{0}".format(query_date.strftime('%Y-%m-%dT%H:%M'))
-    return api_handle.get(url, headers=headers, params={"tiles": tiles})
+    return api_handle.get(__dwell_density_url(query_date), params={"tiles": tiles})
+
+
+def __dwell_density_url(query_date):
+    return BASE_URL + "/heatmaps/dwell-density/hourly/{0}".format(query_date.strftime('%Y-%m-%dT%H:%M'))
+
+
+def get_dwell_density_batch(api_handle, pairs, max_workers=MAX_WORKERS):
+    """Get dwell density for many (date, tiles) pairs using concurrent requests
+
+    Tile lists longer than MAX_NB_TILES_REQUEST are split into several requests.
+
+    :param api_handle: the oauth object to make requests
+    :param pairs: iterable of (query_date, tiles) to query
+    :param max_workers: max number of concurrent requests (capped at MAX_WORKERS)
+    :return: one list of json responses from the API per pair (one response per
+    tile sub-batch), in the order of the pairs
+    """
+    responses = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, MAX_WORKERS)) as ex:
+        future_to_idx = {}
+        for pair_idx, (query_date, tiles) in enumerate(pairs):
+            url = __dwell_density_url(query_date)
+            sub_batches = [tiles[start:start + MAX_NB_TILES_REQUEST]
+                           for start in range(0, len(tiles), MAX_NB_TILES_REQUEST)]
+            responses.append([None] * len(sub_batches))
+            for batch_idx, sub_tiles in enumerate(sub_batches):
+                future = ex.submit(api_handle.get, url, params={"tiles": sub_tiles})
+                future_to_idx[future] = pair_idx, batch_idx
+        for future in as_completed(future_to_idx):
+            pair_idx, batch_idx = future_to_idx[future]
+            responses[pair_idx][batch_idx] = future.result()
+    return responses
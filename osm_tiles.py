@@ -2,40 +2,210 @@
 Module interfacing with the OpenStreetMap API to get map tiles
 """
 import os
-import math
+import functools
+import shutil
+import uuid
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image
+
+try:
+    # optional faster png decoder
+    import pyvips
+except ImportError:
+    pyvips = None
 
 URL = 'https://tile.osm.ch/switzerland/{z}/{x}/{y}.png'
 FILE = 'maps/{z}-{x}-{y}.png'
 MAP_FOLDER = 'maps'
+TILE_SIZE = 256  # width and height of the tiles in pixels
+# number of threads used to download and decode the tiles
+_MAX_THREADS = 16
+# number of decoded tiles kept in memory (~256KB each for 256x256 RGBA)
+_TILE_CACHE_SIZE = int(os.getenv('OSM_TILE_CACHE_SIZE', 512))
+# most recently stitched maps, keyed by tile range and zoom
+_STITCH_CACHE = OrderedDict()
+_STITCH_CACHE_SIZE = 3
+
+# shared session to reuse the connections to the tile server
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'swisscom_challenge-osm-tiles/1.0'})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=_MAX_THREADS, pool_maxsize=_MAX_THREADS,
+    max_retries=Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=[502, 503, 504],
+                      # return the last error response instead of raising
+                      raise_on_status=False)))
+
+
+@contextmanager
+def _atomic_open(file_name):
+    """Open a temporary file that replaces file_name only if written without errors
+
+    :param file_name: path of the final file
+    :return: binary file object to write to
+    """
+    # unique name in the same folder, so concurrent writers never share a file,
+    # created with the same permissions (umask) as a regular open
+    tmp_file_name = f'{file_name}.{uuid.uuid4().hex}.tmp'
+    fd = os.open(tmp_file_name,
+                 os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_file_name, file_name)
+    finally:
+        if os.path.exists(tmp_file_name):
+            os.unlink(tmp_file_name)
+
+
+def get_tile_file_name(x, y, z):
+    """Get the file name of the tile in the local cache
 
+    :param x: "column" number of the tile
+    :param y: "row" number of the tile
+    :param z: zoom value for the tile
+    :return: path of the tile file
+    """
+    return FILE.format(x=x, y=y, z=z)
 
-def get_tile(x, y, z):
+
+def _download_tile(x, y, z):
+    """Download the requested tile and save it
+
+    :param x: "column" number of the tile
+    :param y: "row" number of the tile
+    :param z: zoom value for the tile
+    :return: status code: 1 saved new file, -1 tile not found
+    """
+    file_name = get_tile_file_name(x, y, z)
+    url = URL.format(x=x, y=y, z=z)
+    with _SESSION.get(url, stream=True, timeout=10) as r:
+        if r.ok:
+            # write to a temporary file so partial downloads never end up in the cache
+            r.raw.decode_content = True
+            with _atomic_open(file_name) as f:
+                shutil.copyfileobj(r.raw, f, length=64 * 1024)
+            return 1
+        print(f'Could not get {url} because : {r.status_code}\n{r}')
+        return -1
+
+
+def get_tile(x, y, z, cache_set=None):
     """Saves the requested tile if it not already exists
 
     :param x: "column" number of the tile
     :param y: "row" number of the tile
     :param z: zoom value for the tile
+    :param cache_set: set of the file names in MAP_FOLDER, avoids checking the
+    filesystem for each tile when given
     :return: status code:
     1 saved new file, -1 tile not found, 0 using cached version
     """
-    file_name = FILE.format(x=x, y=y, z=z)
-    if not os.path.exists(file_name):
-        # request the file and save it
-        url = URL.format(x=x, y=y, z=z)
-        r = requests.get(url)
-        if r.ok:
-            with open(file_name, 'wb') as f:
-                f.write(r.content)
-                return 1
-        else:
-            print(f'Could not get {url} because : {r.status_code}\n{r}')
-            return -1
+    file_name = get_tile_file_name(x, y, z)
+    if cache_set is not None:
+        is_cached = os.path.basename(file_name) in cache_set
     else:
-        # Using cached version
-        return 0
+        is_cached = os.path.exists(file_name)
+    if not is_cached:
+        # request the file and save it
+        return _download_tile(x, y, z)
+    # Using cached version
+    return 0
+
+
+def _decode_png(file_name):
+    """Decode a png tile, using pyvips if available and Pillow otherwise
+
+    :param file_name: path of the png tile
+    :return: RGBA tile array (uint8)
+    """
+    if pyvips is not None:
+        image = pyvips.Image.new_from_file(file_name, access='sequential').colourspace('srgb')
+        if not image.hasalpha():
+            image = image.bandjoin(255)
+        return image.numpy()
+    with Image.open(file_name) as image:
+        return np.asarray(image.convert('RGBA'))
+
+
+def _load_tile(file_name):
+    """Load a decoded tile, using the .npy copy next to the .png if present and
+    up to date
+
+    :param file_name: path of the png tile
+    :return: decoded RGBA tile array (uint8)
+    """
+    npy_path = file_name.replace('.png', '.npy')
+    # only use the copy if it is not older than the png (e.g. tile downloaded again)
+    if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= os.path.getmtime(file_name):
+        try:
+            arr = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError):
+            arr = None
+        if arr is not None and arr.dtype == np.uint8:
+            return arr
+        # corrupted or outdated float copy, decode the png again
+        del arr
+    arr = _decode_png(file_name)
+    with _atomic_open(npy_path) as f:
+        np.save(f, arr)
+    return arr
+
+
+@functools.lru_cache(maxsize=_TILE_CACHE_SIZE)
+def _load_tile_cached(file_name):
+    """Load a decoded tile, keeping the most recently used ones in memory
+
+    :param file_name: path of the png tile
+    :return: read-only decoded tile array
+    """
+    # in-memory copy, a cached memmap would keep its file descriptor open
+    arr = np.array(_load_tile(file_name))
+    arr.setflags(write=False)
+    return arr
+
+
+def deg2num_vec(lat_deg, lon_deg, zoom):
+    """Convert arrays of latitudes and longitudes to tile coords (x, y)
+
+    :param lat_deg: latitudes in degrees
+    :param lon_deg: longitudes in degrees
+    :param zoom: zoom level (1 to 16)
+    :return: arrays of tile coords (x, y)
+    """
+    lat_rad = np.radians(np.asarray(lat_deg, dtype=np.float64))
+    lon_deg = np.asarray(lon_deg, dtype=np.float64)
+    n = 1 << zoom
+    x_tile = np.floor((lon_deg + 180.0) * n / 360.0).astype(np.int32)
+    # asinh(tan(lat)) == log(tan(lat) + sec(lat))
+    y_tile = np.floor((1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) * 0.5 * n).astype(np.int32)
+    return x_tile, y_tile
+
+
+def num2deg_vec(x_tile, y_tile, zoom):
+    """Convert arrays of tile coords into latitudes and longitudes of the NW
+    corners of the tiles
+
+    :param x_tile: "columns" of the tiles
+    :param y_tile: "rows" of the tiles
+    :param zoom: zoom level of the tiles
+    :return: latitudes and longitudes of the north-west corners of the tiles
+    """
+    x_tile = np.asarray(x_tile, dtype=np.float64)
+    y_tile = np.asarray(y_tile, dtype=np.float64)
+    n = 2.0 ** zoom
+    lon_deg = x_tile / n * 360.0 - 180.0
+    lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * y_tile / n)))
+    lat_deg = np.degrees(lat_rad)
+    return lat_deg, lon_deg
 
 
 def deg2num(lat_deg, lon_deg, zoom):
@@ -46,11 +216,8 @@ def deg2num(lat_deg, lon_deg, zoom):
     :param zoom: zoom level (1 to 16)
     :return: tile coords (x, y)
     """
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    x_tile = int((lon_deg + 180.0) / 360.0 * n)
-    y_tile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
-    return x_tile, y_tile
+    x_tile, y_tile = deg2num_vec(lat_deg, lon_deg, zoom)
+    return int(x_tile), int(y_tile)
 
 
 def num2deg(x_tile, y_tile, zoom):
@@ -61,11 +228,8 @@ def num2deg(x_tile, y_tile, zoom):
     :param zoom: zoom level of the tile
     :return: latitude and longitude of the north-west corner of the tile
     """
-    n = 2.0 ** zoom
-    lon_deg = x_tile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y_tile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return lat_deg, lon_deg
+    lat_deg, lon_deg = num2deg_vec(x_tile, y_tile, zoom)
+    return float(lat_deg), float(lon_deg)
 
 
 def bboxtile(x_tile, y_tile, zoom, nb_x_tiles=1, nb_y_tiles=1):
@@ -80,19 +244,13 @@ def bboxtile(x_tile, y_tile, zoom, nb_x_tiles=1, nb_y_tiles=1):
     :param nb_y_tiles: number of tiles in the rows (height)
     :return: bounding box (left, right, bottom, top) in latitude and longitude
     """
-    n = 2.0 ** zoom
-    # long min
-    lon_min_deg = x_tile / n * 360.0 - 180.0
-    # long max
-    lon_max_deg = (x_tile + nb_x_tiles) / n * 360.0 - 180.0
-    # lat max
-    lat_max_rad = math.atan(math.sinh(math.pi * (1 - 2 * y_tile / n)))
-    lat_max_deg = math.degrees(lat_max_rad)
-    # lat min
-    lat_min_rad = math.atan(math.sinh(math.pi * (1 - 2 * (y_tile + nb_y_tiles) / n)))
-    lat_min_deg = math.degrees(lat_min_rad)
+    # NW corner of the first tile and NW corner of the tile after the last one
+    lat_deg, lon_deg = num2deg_vec([x_tile, x_tile + nb_x_tiles],
+                                   [y_tile, y_tile + nb_y_tiles], zoom)
+    lat_max_deg, lat_min_deg = lat_deg
+    lon_min_deg, lon_max_deg = lon_deg
     # left, right, bottom, top
-    return lon_min_deg, lon_max_deg, lat_min_deg, lat_max_deg
+    return float(lon_min_deg), float(lon_max_deg), float(lat_min_deg), float(lat_max_deg)
 
 
 def compute_aspect(bbox, map_size):
@@ -140,12 +298,14 @@ def plot_map_status(map_status, zoom, map_size, x_tile_min, x_tile_max,
     plt.show()
 
 
-def get_stitched_map_and_bbox(df, zoom, verbose=False):
+def get_stitched_map_and_bbox(df, zoom, verbose=False, force_rebuild=False):
     """Get a map spanning all the coords in df
 
     :param df: dataframe of the tiles
     :param zoom: desired zoom level
     :param verbose: whether to display status informations
+    :param force_rebuild: whether to stitch the map again even if it was
+    already built for the same tiles, also reloads the tiles kept in memory
     :return: stitched map, bounding box of the map, map size
     """
     long_min = df.ll_x.min()  # long min
@@ -153,8 +313,10 @@ def get_stitched_map_and_bbox(df, zoom, verbose=False):
     lat_min = df.ll_y.min()  # lat min
     lat_max = df.ur_y.max()  # lat max
 
-    x_tile_min, y_tile_max = deg2num(lat_min, long_min, zoom)
-    x_tile_max, y_tile_min = deg2num(lat_max, long_max, zoom)
+    # SW and NE corners converted in one call
+    x_tiles, y_tiles = deg2num_vec([lat_min, lat_max], [long_min, long_max], zoom)
+    x_tile_min, x_tile_max = x_tiles.tolist()
+    y_tile_max, y_tile_min = y_tiles.tolist()
 
     map_size = ((y_tile_max - y_tile_min) + 1, (x_tile_max - x_tile_min) + 1)
     if verbose:
@@ -163,32 +325,60 @@ def get_stitched_map_and_bbox(df, zoom, verbose=False):
         print(f'Using tiles in x : from {x_tile_min} to {x_tile_max}')
         print(f'Using tiles in y : from {y_tile_min} to {y_tile_max}')
 
-    # check maps folder existence
-    if not os.path.exists(MAP_FOLDER):
-        os.mkdir(MAP_FOLDER)
+    cache_key = (x_tile_min, x_tile_max, y_tile_min, y_tile_max, zoom)
+    if not force_rebuild and cache_key in _STITCH_CACHE:
+        if verbose:
+            print('Using cached stitched map')
+        _STITCH_CACHE.move_to_end(cache_key)
+        return _STITCH_CACHE[cache_key]
+    if force_rebuild:
+        # pick up tiles changed on disk
+        _load_tile_cached.cache_clear()
 
     tiles_status = np.zeros(map_size)
+    # tiles that could not be fetched stay transparent
+    stitched_map = np.zeros((map_size[0] * TILE_SIZE, map_size[1] * TILE_SIZE, 4),
+                            dtype=np.uint8)
 
-    for i, x_tile_num in enumerate(range(x_tile_min, x_tile_max + 1)):
-        for j, y_tile_num in enumerate(range(y_tile_min, y_tile_max + 1)):
-            # look if the image already exists
-            tiles_status[j, i] = get_tile(x=x_tile_num, y=y_tile_num, z=zoom)
+    # list the tiles that are already cached (the folder may have been removed)
+    os.makedirs(MAP_FOLDER, exist_ok=True)
+    with os.scandir(MAP_FOLDER) as entries:
+        cached = {entry.name for entry in entries}
+
+    def fetch_and_copy_tile(i, j, x, y):
+        try:
+            status = get_tile(x, y, zoom, cache_set=cached)
+        except requests.RequestException as e:
+            url = URL.format(x=x, y=y, z=zoom)
+            print(f'Could not get {url} because : {e}')
+            return -1
+        if status >= 0:
+            stitched_map[j * TILE_SIZE:(j + 1) * TILE_SIZE,
+                         i * TILE_SIZE:(i + 1) * TILE_SIZE] = _load_tile_cached(get_tile_file_name(x, y, zoom))
+        return status
+
+    # download (if needed), decode and stitch the tiles concurrently
+    with ThreadPoolExecutor(max_workers=_MAX_THREADS) as ex:
+        future_to_idx = {ex.submit(fetch_and_copy_tile, i, j, x_tile_num, y_tile_num): (j, i)
+                         for i, x_tile_num in enumerate(range(x_tile_min, x_tile_max + 1))
+                         for j, y_tile_num in enumerate(range(y_tile_min, y_tile_max + 1))}
+        for future in as_completed(future_to_idx):
+            tiles_status[future_to_idx[future]] = future.result()
     if verbose:
         print('Done!')
         plot_map_status(tiles_status, zoom, map_size, x_tile_min, x_tile_max,
                         y_tile_min, y_tile_max)
 
-    # stitch the map together
-    background_map = []
-    for i, x_tile_num in enumerate(range(x_tile_min, x_tile_max + 1)):
-        map_col = []
-        for j, y_tile_num in enumerate(range(y_tile_min, y_tile_max + 1)):
-            file_name = FILE.format(x=x_tile_num, y=y_tile_num, z=zoom)
-            map_col.append(plt.imread(file_name))
-        background_map.append(np.vstack(map_col))
-
-    stitched_map = np.concatenate(background_map, axis=1)
     bbox = bboxtile(x_tile_min, y_tile_min, zoom, nb_x_tiles=map_size[1],
                     nb_y_tiles=map_size[0])
 
+    # the map is shared between calls, prevent modifications
+    stitched_map.setflags(write=False)
+    # only keep complete maps, missing tiles are fetched again on the next call
+    if (tiles_status >= 0).all():
+        _STITCH_CACHE[cache_key] = stitched_map, bbox, map_size
+        _STITCH_CACHE.move_to_end(cache_key)
+        if len(_STITCH_CACHE) > _STITCH_CACHE_SIZE:
+            _STITCH_CACHE.popitem(last=False)
+
     return stitched_map, bbox, map_size
@@ -4,14 +4,18 @@ Visualization module providing utility functions to plot maps
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
 from matplotlib.patches import Rectangle
+from matplotlib.collections import PatchCollection
 from matplotlib.animation import FuncAnimation
 import matplotlib.cm as cm
 import numpy as np
+import pandas as pd
 import osm_tiles
 
+TILE_COLS = ['ll_x', 'ur_x', 'll_y', 'ur_y']
+
 
 def get_cmap(df, color_col):
-    """Get the normalized colormap based on the maximum value of df
+    """Get the normalized colormap based on the minimum and maximum values of df
 
     :param df: Dataframe of values
     :param color_col: Columns from which to plot colors
@@ -19,7 +23,7 @@ def get_cmap(df, color_col):
     """
     if color_col:
         cmap = cm.rainbow
-        norm = Normalize(vmax=df[color_col].max())
+        norm = Normalize(vmin=df[color_col].min(), vmax=df[color_col].max())
         return lambda x: cmap(norm(x))
     return None
 
@@ -34,8 +38,44 @@ def get_subplot_grid_size(nb_groups):
     return diag_size, diag_size + 1
 
 
+def get_tiles_array(df, color_col=None):
+    """Utility function that extracts the tiles coordinates (and color values) of df
+
+    :param df: Dataframe of values
+    :param color_col: column from which the color is inferred
+    :return: contiguous array with one row per tile: ll_x, ur_x, ll_y, ur_y (, color_col)
+    """
+    cols = TILE_COLS + ([color_col] if color_col else [])
+    return np.ascontiguousarray(df[cols].to_numpy(dtype=np.float32))
+
+
+def add_tile_rects_arr(tiles, ax, cmap_norm_func, discrete=True):
+    """Utility function that adds a collection of Rectangles to an axis based on a tiles array
+
+    :param tiles: array of the tiles, as returned by get_tiles_array
+    :param ax: axis of the plot
+    :param cmap_norm_func: normalized colormap function
+    :param discrete: whether to plot discreet colors ('C0', 'C1', ...)
+    """
+    ll_x, ur_x, ll_y, ur_y = tiles[:, :4].T
+    values = tiles[:, 4] if tiles.shape[1] > 4 else None
+    widths = ur_x - ll_x
+    heights = ll_y - ur_y
+    if discrete:
+        colors = [f'C{int(v)}' for v in values]
+    else:
+        colors = cmap_norm_func(values) if cmap_norm_func else 'b'
+    tile_rects = [Rectangle((lx, uy), w, h)  # anchor, width, height
+                  for lx, uy, w, h in zip(ll_x, ur_y, widths, heights)]
+    ax.add_collection(PatchCollection(tile_rects,
+                                      facecolors=colors,
+                                      edgecolors='k',
+                                      alpha=0.5
+                                      ))
+
+
 def add_tile_rects(df, ax, cmap_norm_func, color_col, discrete=True):
-    """Utility function that adds Rectangle artists to an axis based on values in df
+    """Utility function that adds a collection of Rectangles to an axis based on values in df
 
     :param df: Dataframe of values
     :param ax: axis of the plot
@@ -43,20 +83,8 @@ def add_tile_rects(df, ax, cmap_norm_func, color_col, discrete=True):
     :param color_col: column from which the color is inferred
     :param discrete: whether to plot discreet colors ('C0', 'C1', ...)
     """
-    for r_idx, tile in df.iterrows():
-        if discrete:
-            color = f'C{int(tile[color_col])}'
-        else:
-            color = cmap_norm_func(tile[color_col]) if cmap_norm_func else 'b'
-        tile_rect = Rectangle((tile.ll_x, tile.ur_y),  # anchor
-                              (tile.ur_x - tile.ll_x),  # width
-                              (tile.ll_y - tile.ur_y),  # height
-                              ec='k',
-                              fill=True,
-                              fc=color,
-                              alpha=0.5
-                              )
-        ax.add_patch(tile_rect)
+    add_tile_rects_arr(get_tiles_array(df, color_col), ax, cmap_norm_func,
+                       discrete=discrete)
 
 
 def plot_all_tiles_on_map(df, stitched_map, bbox, map_size, color_col=None):
@@ -90,11 +118,13 @@ def plot_tiles_on_map_by_groups(df, stitched_map, bbox, map_size, group_col=None
     """
     cmap_func = get_cmap(df, group_col)
     aspect = osm_tiles.compute_aspect(bbox, map_size)
-    nb_groups = len(df[group_col].unique())
+    group_codes, groups = pd.factorize(df[group_col], sort=True)
+    nb_groups = len(groups)
+    tiles = get_tiles_array(df, group_col)
     rows, cols = get_subplot_grid_size(nb_groups)
     fig, axes = plt.subplots(figsize=(15, 12), nrows=rows, ncols=cols, dpi=100)
-    for (group, sub_df), ax in zip(df.groupby(group_col), axes.flatten()):
-        add_tile_rects(sub_df, ax, cmap_func, group_col)
+    for k, ax in zip(range(nb_groups), axes.flatten()):
+        add_tile_rects_arr(tiles[group_codes == k], ax, cmap_func)
         ax.imshow(stitched_map, zorder=0, extent=bbox, aspect=aspect)
     for ax in axes.flatten()[nb_groups:]:
         ax.clear()
@@ -115,28 +145,32 @@ def animated_plot(fig, ax, df, stitched_map, bbox, map_size, columns):
     :param columns: column to use for the animation
     :return: animation object
     """
-    rects = []
+    tiles_collection = None
+    # colors of every tile for every frame, shape (nb_tiles, nb_frames, 4),
+    # normalized on the whole animation so colors are comparable across frames
+    values = df[columns].to_numpy()
+    norm = Normalize(vmax=values.max())
+    colors = cm.rainbow(norm(values))
+    frame_idx = {col: k for k, col in enumerate(columns)}
+    aspect = osm_tiles.compute_aspect(bbox, map_size)
 
     def init():
-        aspect = osm_tiles.compute_aspect(bbox, map_size)
-        for r_idx, tile in df.iterrows():
-            tile_rect = Rectangle((tile.ll_x, tile.ur_y),  # anchor
-                                  (tile.ur_x - tile.ll_x),  # width
-                                  (tile.ll_y - tile.ur_y),  # height
-                                  fill=True,
-                                  fc='b',
-                                  alpha=0.5
-                                  )
-            ax.add_patch(tile_rect)
-            rects.append(tile_rect)
+        nonlocal tiles_collection
+        ll_x, ur_x, ll_y, ur_y = get_tiles_array(df).T
+        rects = [Rectangle((lx, uy), w, h)  # anchor, width, height
+                 for lx, uy, w, h in zip(ll_x, ur_y, ur_x - ll_x, ll_y - ur_y)]
+        tiles_collection = PatchCollection(rects,
+                                           facecolors='b',
+                                           edgecolors='face',
+                                           alpha=0.5
+                                           )
+        ax.add_collection(tiles_collection)
         ax.imshow(stitched_map, zorder=0, extent=bbox, aspect=aspect)
         return ax
-    
+
     def anim_func(i):
-        cmap_func = get_cmap(df, i)
         ax.set_title(i)
-        for idx, r in enumerate(rects):
-            r.set(color=cmap_func(df.iloc[idx][i]))
+        tiles_collection.set_facecolors(colors[:, frame_idx[i]])
 
     anim = FuncAnimation(fig,
                          init_func=init,